@@ -1,25 +1,50 @@
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from contextvars import ContextVar
 from dataclasses import dataclass, field
+from functools import lru_cache
+from io import StringIO
 from typing import Any, Callable, Self, Optional
 from deap import gp
-import pygraphviz as pgv, os, numpy as np, numpy.typing as npt
+import pygraphviz as pgv, os, hashlib, tempfile, numpy as np, numpy.typing as npt
 from matplotlib import pyplot as plt
 import PIL.Image
 
 type TreeNode = gp.Primitive | gp.Terminal
 type image = npt.ArrayLike | PIL.Image.Image
 
+# png encoding releases the GIL, so get_graph writes images in the background while the rest of the graph is built
+_image_writer = ThreadPoolExecutor(max_workers=os.cpu_count())
+# the unfinished write to each image file, image files are named by their content so identical images are only written once
+_image_writes: dict[str, Future[None]] = {}
+# the size (in pixels) draw_image's 2 inch image nodes are shown at, thumbnails are scaled up to it
+_THUMBNAIL_SIZE = 144
+# modes that can be saved as a png as they are
+_PNG_MODES = {"1", "L", "LA", "P", "I", "RGB", "RGBA"}
+
 
 @dataclass
-class Box[T]:
+class _Drawing:
     """
-    A mutable holder of some value.
+    The state of a single TreeDrawer.get_graph call, kept off the trees so they aren't tied to one drawing.
 
     Attributes
     ----------
-    value : T
-        Some value of the generic type T
+    thumbnails : dict[str, tuple[Any, np.ndarray]]
+        The pre-normalized uint8 version of each image value, by tree id (along with the value it was made from).
+    image_writes : list[tuple[Tree, Future[None]]]
+        The background image writes started by draw_image (along with the tree they're drawn for), which need to finish before the layout.
     """
-    value: T
+    thumbnails: dict[str, tuple[Any, np.ndarray]] = field(default_factory=dict)
+    image_writes: list[tuple["Tree", Future[None]]] = field(default_factory=list)
+
+_drawing: ContextVar[Optional[_Drawing]] = ContextVar("_drawing", default=None)
+
+
+@lru_cache(maxsize=4096)
+def _compile(expression: str, pset: gp.PrimitiveSetTyped | gp.PrimitiveSet) -> Callable[..., Any]:
+    # the same expressions get compiled over and over (eg. for drawing and evaluation), so reuse the compiled function
+    return gp.compile(expression, pset=pset)
+
 
 @dataclass
 class Tree[T]:
@@ -36,12 +61,54 @@ class Tree[T]:
         The pset that this exists in the context of.
     value : Optional[T]
         The value of this tree after a given input (starts as none, will get set when this node is evaluated on some input)
+
+    Notes
+    -----
+    evaluate looks each node up in the pset the first time it runs (and again whenever the node's function is replaced),
+    so other changes to the pset after that (eg. renameArguments, or adding a terminal with the same name) are not picked up by evaluate.
     """
     function: TreeNode
     children: list["Tree"]
     pset: gp.PrimitiveSetTyped | gp.PrimitiveSet
     value: Optional[T] = None
 
+    def __post_init__(self):
+        self._set_ids()
+        # what this node does, looked up in the pset on the first evaluate (so building a tree never needs the pset to be complete),
+        # along with the function it was looked up for
+        self._resolved_for: Optional[TreeNode] = None
+        self._impl: Optional[Callable[..., Any]] = None
+        self._arg_index = -1
+        self._const: Any = None
+
+    def __setstate__(self, state: dict[str, Any]) -> None:
+        # copying (or unpickling) makes a new node, which needs its own ids rather than the ones of the node it came from
+        self.__dict__.update(state)
+        self._set_ids()
+
+    def _set_ids(self) -> None:
+        # the ids are used many times while drawing, so only build the strings once
+        self._id = str(id(self))
+        self._result_id = self._id + "result"
+
+    def _resolve(self) -> None:
+        # resolve what this node does once, so evaluating it needs no lookups in the pset
+        # (terminals are resolved the same way gp.compile would when evaluating the formatted expression)
+        self._impl = None
+        self._arg_index = -1
+        self._const = None
+        if isinstance(self.function, gp.Primitive):
+            self._impl = self.pset.context[self.function.name]
+        else:
+            symbol = self.function.format()
+            if symbol in self.pset.arguments:
+                self._arg_index = self.pset.arguments.index(symbol)
+            elif symbol in self.pset.context:
+                self._const = self.pset.context[symbol]
+            else:
+                self._const = self.function.value
+        self._resolved_for = self.function
+
     @staticmethod
     def of(model: list[TreeNode], pset: gp.PrimitiveSetTyped | gp.PrimitiveSet) -> 'Tree':
         """
@@ -54,13 +121,29 @@ class Tree[T]:
         pset : gp.PrimitiveSetTyped
             The pset associated with the model
         """
-        return Tree._construct_tree(model, pset, Box(0))
+        return Tree._construct_tree(model, pset)
 
     @staticmethod
-    def _construct_tree(model: list[TreeNode], pset: gp.PrimitiveSetTyped | gp.PrimitiveSet, index: Box[int]) -> "Tree":
-        function = model[index.value]
-        index.value += 1
-        return Tree(function, [Tree._construct_tree(model, pset, index) for _ in range(function.arity)], pset)
+    def _construct_tree(model: list[TreeNode], pset: gp.PrimitiveSetTyped | gp.PrimitiveSet) -> "Tree":
+        # built iteratively (rather than recursively) so tall trees can't hit the recursion limit
+        root = Tree(model[0], [], pset)
+        # nodes which still need children, along with how many more children they need
+        stack: list[tuple[Tree, int]] = [(root, root.function.arity)] if root.function.arity else []
+        for function in model[1:]:
+            if not stack:
+                break
+
+            parent, remaining = stack.pop()
+            node = Tree(function, [], pset)
+            parent.children.append(node)
+            if remaining > 1:
+                stack.append((parent, remaining - 1))
+            if function.arity:
+                stack.append((node, function.arity))
+
+        if stack:
+            raise ValueError("model is missing nodes")
+        return root
 
 
     def __repr__(self) -> str:
@@ -83,7 +166,7 @@ class Tree[T]:
         Callable[..., T]
             The function version of this tree.
         """
-        return gp.compile(self, pset=self.pset)
+        return _compile(repr(self), self.pset)
 
     def id(self) -> str:
         """
@@ -94,14 +177,72 @@ class Tree[T]:
         str
             A unique identifier for this object.
         """
+        return self._id
 
-        return str(id(self))
+    def result_id(self) -> str:
+        """
+        The identifier used for the node that displays the value of this tree.
 
-    def _evaluate_all_nodes(self, *inputs) -> Any:
-        self.value = self.compile()(*inputs)
+        Returns
+        -------
+        str
+            The id of this tree with "result" appended.
+        """
+        return self._result_id
 
-        for child in self.children:
-            child._evaluate_all_nodes(*inputs)
+    def evaluate(self, *inputs: Any, parallel: bool=False) -> T:
+        """
+        Run the tree on the given input(s) by calling the pset's primitives directly (without gp.compile),
+        setting the value of every node in the tree along the way.
+
+        Parameters
+        ----------
+        *inputs : Any
+            The arguments to the tree.
+        parallel : bool
+            Evaluate each of the root's subtrees on its own thread, False by default.
+            This only helps when the primitives release the GIL (eg. numpy on large arrays), and they must be thread safe.
+
+        Returns
+        -------
+        T
+            The result of the whole tree.
+        """
+        if not parallel or len(self.children) < 2:
+            return self._evaluate_subtree(inputs)
+
+        # the subtrees share no nodes, so they can each set their values from separate threads
+        with ThreadPoolExecutor(max_workers=min(len(self.children), os.cpu_count() or 1)) as executor:
+            operands = list(executor.map(lambda child: child._evaluate_subtree(inputs), self.children))
+        if self.function is not self._resolved_for:
+            self._resolve()
+        self.value = self._impl(*operands)
+        return self.value
+
+    def _evaluate_subtree(self, inputs: tuple[Any, ...]) -> T:
+        # reversed preorder visits every child before its parent, so the operands are always on top of the stack
+        stack: list[Any] = []
+        for tree in reversed(self.nodes()):
+            if tree.function is not tree._resolved_for:
+                tree._resolve()
+            if tree._impl is not None:
+                # (slicing from the front, as stack[-0:] would be the whole stack for zero argument primitives)
+                start = len(stack) - tree.function.arity
+                operands = stack[start:]
+                del stack[start:]
+                # the later children were visited first, so they are lower in the stack
+                operands.reverse()
+                tree.value = tree._impl(*operands)
+            elif tree._arg_index >= 0:
+                tree.value = inputs[tree._arg_index]
+            else:
+                tree.value = tree._const
+            stack.append(tree.value)
+
+        return stack.pop()
+
+    def _evaluate_all_nodes(self, *inputs) -> Any:
+        return self.evaluate(*inputs)
 
     def nodes(self) -> list["Tree"]:
         """
@@ -112,19 +253,25 @@ class Tree[T]:
         list[Tree]
             A list of nodes, which is all nodes in this tree, in recursive depth first order
         """
-        return [self] + sum((child.nodes() for child in self.children), [])
+        nodes = []
+        stack = [self]
+        while stack:
+            tree = stack.pop()
+            nodes.append(tree)
+            stack.extend(reversed(tree.children))
+        return nodes
 
 
 @dataclass
 class TreeDrawer:
-    drawing_method: list[tuple[Callable[[Tree], bool], Callable[[pgv.AGraph, Tree], None]]] = field(default_factory=list)
+    drawing_method: list[tuple[Callable[[Tree], bool], Callable[[pgv.AGraph, Tree], Optional[bool]]]] = field(default_factory=list)
+    parallel_evaluation: bool = False
 
     def __post_init__(self):
         self.drawing_method = []
-        self\
-            .register_draw_function(lambda _: True, draw_text)\
-            .register_draw_function(lambda t: is_image(t.value), draw_image)\
-            .register_draw_function(lambda t: t.function.arity == 0 and "ARG" not in t.function.name, lambda *_: None)
+        # the defaults are one catch all rule that switches on the kind of the tree (worked out once),
+        # rather than a rule per kind that would each need their predicate checked
+        self.register_draw_function(lambda _: True, _draw_default)
 
     def clear_defaults(self) -> Self:
         """
@@ -137,7 +284,7 @@ class TreeDrawer:
         self.drawing_method = []
         return self
 
-    def register_draw_function(self, predicate: Callable[[Tree], bool], draw_function: Callable[[pgv.AGraph, Tree], None]) -> Self:
+    def register_draw_function(self, predicate: Callable[[Tree], bool], draw_function: Callable[[pgv.AGraph, Tree], Optional[bool]]) -> Self:
         """
         Register a new draw method.
         The newest draw function will take precidence before the old one, and only one will get called.
@@ -147,8 +294,9 @@ class TreeDrawer:
         predicate : Callable[[Tree], bool]
             The trigger for when to run this draw function, when the predicate returns true, the draw function is called
 
-        draw_function : Callable[[pgv.AGraph, Tree], None]]
-            The used to draw the given result
+        draw_function : Callable[[pgv.AGraph, Tree], Optional[bool]]]
+            The used to draw the given result, it can return whether it added a node with the tree's result_id()
+            (if it returns None the graph is checked for that node instead)
 
         Returns
         -------
@@ -184,47 +332,93 @@ class TreeDrawer:
         *inputs : Any
             The inputs to pass into the tree to visualize.
         """
-        tree._evaluate_all_nodes(*inputs)
-
-        graph = pgv.AGraph(strict=False, directed=True)
-
-        # requires a directory to store images in :(
-        if not os.path.isdir('_treedata'):
-            os.makedirs('_treedata')
+        tree.evaluate(*inputs, parallel=self.parallel_evaluation)
+        # the (iterative) preorder flattening is shared by every pass below, rather than recursing through the tree
+        nodes = tree.nodes()
+        drawing = _Drawing(thumbnails=self._normalize_thumbnails(nodes))
+
+        graph = self._build_graph(nodes)
+        # the draw functions (newest first, as stored) as a tuple built once for the whole graph,
+        # so edits to drawing_method are always seen by the next graph
+        dispatch = tuple(self.drawing_method)
+        token = _drawing.set(drawing)
+        try:
+            for node in nodes:
+                self._display_value(node, graph, dispatch)
+        finally:
+            _drawing.reset(token)
+
+        # the images need to be written before the layout can use them
+        for written, image_write in drawing.image_writes:
+            try:
+                image_write.result()
+            except Exception as e:
+                # like any other failed draw function, that one node is drawn as text instead
+                print(e)
+                graph.get_node(written._result_id).attr.update(image="", imagescale="", fixedsize="", width="", height="", label=str(written.value))
 
-        self._populate_graph(tree, graph)
         graph.layout(prog="dot")
         return graph
 
-    def _populate_graph(self, tree: Tree, graph: pgv.AGraph) -> None:
-        if tree.function.arity == 0:
-            graph.add_node(tree.id(), label=tree.function.format())
-        else:
-            graph.add_node(tree.id(), label=tree.function.name)
-
-        self._display_value(tree, graph)
-
-        for child in tree.children:
-            self._populate_graph(child, graph)
-            graph.add_edge(tree.id(), child.id(), dir="back")
-
-    def _display_value(self, tree: Tree, graph: pgv.AGraph) -> None:
-        for predicate, draw_function in self.drawing_method:
+    def _normalize_thumbnails(self, nodes: list[Tree]) -> dict[str, tuple[Any, np.ndarray]]:
+        # normalize all the same shaped images together in one vectorized pass, instead of one at a time as they are drawn
+        # (only numbers can be normalized, other arrays are left to whichever draw function handles them)
+        by_shape: dict[tuple[int, ...], list[Tree]] = {}
+        for node in nodes:
+            value = node.value
+            if isinstance(value, np.ndarray) and value.ndim == 2 and (np.issubdtype(value.dtype, np.number) or value.dtype == bool):
+                by_shape.setdefault(value.shape, []).append(node)
+
+        thumbnails = {}
+        for same_shape in by_shape.values():
+            try:
+                normalized = _normalize_images(np.stack([node.value for node in same_shape]))
+            except Exception:
+                # the nodes without a thumbnail are drawn one at a time instead, where a failure only affects that node
+                continue
+            for node, thumbnail in zip(same_shape, normalized):
+                thumbnails[node._id] = (node.value, thumbnail)
+        return thumbnails
+
+    def _build_graph(self, nodes: list[Tree]) -> pgv.AGraph:
+        # the tree itself is handed to pygraphviz as one dot source, rather than a call per node and edge
+        dot = StringIO()
+        dot.write("digraph {\n")
+        for node in nodes:
+            if node.function.arity == 0:
+                label = node.function.format()
+            else:
+                label = node.function.name
+            dot.write(f'"{node._id}" [label={_quote(label)}];\n')
+
+        for node in nodes:
+            for child in node.children:
+                dot.write(f'"{node._id}" -> "{child._id}" [dir=back];\n')
+        dot.write("}\n")
+        return pgv.AGraph(string=dot.getvalue())
+
+    def _display_value(self, tree: Tree, graph: pgv.AGraph, dispatch: tuple[tuple[Callable[[Tree], bool], Callable[[pgv.AGraph, Tree], Optional[bool]]], ...]) -> None:
+        added = None
+        for predicate, draw_function in dispatch:
             try:
                 if predicate(tree):
-                    draw_function(graph, tree)
+                    added = draw_function(graph, tree)
                     break
             except Exception as e:
                 print(e)
         else:
-            draw_text(graph, tree, str(tree.value))
-        if not graph.has_node(f"{tree.id()}result"):
-            return None
+            added = draw_text(graph, tree, str(tree.value))
 
-        graph.add_edge(tree.id(), f"{tree.id()}result", style="invis", dir="both")
+        # only ask the graph when the draw function didn't say whether it added a result node
+        if added is None:
+            added = graph.has_node(tree._result_id)
+        if not added:
+            return None
 
-        result_holder = graph.add_subgraph([tree.id(),f"{tree.id()}result"], name=f"{tree.id()}-resultholder")
+        # adding the edge straight to the subgraph, as passing the nodes to add_subgraph scans every edge in the graph
+        result_holder = graph.add_subgraph(name=f"{tree._id}-resultholder")
         result_holder.graph_attr['rank']='same'
+        result_holder.add_edge(tree._id, tree._result_id, style="invis", dir="both")
 
 
 def show_img(img: image, title: str='') -> None:
@@ -266,6 +460,73 @@ def save_img(img: image, save_to: str, title: str='') -> None:
     plt.close()
 
 
+def save_img_fast(img: image, save_to: str) -> None:
+    """
+    Save an image as a png, scaling the pixel values to fill the 0-255 range
+    (PIL images in a mode png supports, and uint8 RGB(A) arrays, are saved as they are), and scaling small images up so their pixels stay sharp.
+    Unlike save_img this skips matplotlib (and the colorbar), which makes it much cheaper for drawing many thumbnails.
+    Arrays that aren't greyscale (H, W), RGB (H, W, 3) or RGBA (H, W, 4) are handed to save_img instead.
+
+    Parameters
+    ----------
+    img : npt.ArrayLike | PIL.Image.Image
+        The image to save, either a PIL image or an array.
+    save_to : str
+        The filepath to save to
+    """
+    if isinstance(img, PIL.Image.Image):
+        if img.mode in _PNG_MODES:
+            _upscale(img).save(save_to, optimize=False, compress_level=1)
+            return
+        if len(img.getbands()) > 1:
+            _upscale(img.convert("RGBA")).save(save_to, optimize=False, compress_level=1)
+            return
+        # eg. floating point images, which get normalized like arrays
+        img = np.asarray(img)
+
+    array = np.asarray(img)
+    if array.ndim == 3 and array.shape[2] == 1:
+        array = array[:, :, 0]
+    if array.ndim == 2 or (array.ndim == 3 and array.shape[2] in (3, 4)):
+        if array.ndim == 2 or array.dtype != np.uint8:
+            array = _normalize_images(array[np.newaxis])[0]
+        _save_thumbnail(array, save_to)
+        return
+    save_img(img, save_to)
+
+
+def _normalize_images(images: np.ndarray) -> np.ndarray:
+    # scales each image in an (N, H, W) or (N, H, W, channels) stack to fill the 0-255 range
+    # (the range only comes from the finite values, inf and -inf are drawn as the max and min, and nan as the min)
+    images = np.asarray(images, dtype=np.float64)
+    flat = images.reshape(len(images), -1)
+    finite = np.isfinite(flat)
+    mins = np.where(finite, flat, np.inf).min(axis=1)
+    maxs = np.where(finite, flat, -np.inf).max(axis=1)
+    # images without any finite values have no range
+    mins[~np.isfinite(mins)] = 0
+    ranges = maxs - mins
+    ranges[~np.isfinite(ranges) | (ranges == 0)] = 1
+    # one value per image, broadcast over the rest of its dimensions
+    per_image = (len(images),) + (1,) * (images.ndim - 1)
+    scaled = (images - mins.reshape(per_image)) * (255.0 / ranges).reshape(per_image)
+    return np.clip(np.nan_to_num(scaled, nan=0, posinf=255, neginf=0), 0, 255).astype(np.uint8)
+
+
+def _save_thumbnail(thumbnail: np.ndarray, save_to: str) -> None:
+    # a uint8 (H, W) greyscale, (H, W, 3) RGB or (H, W, 4) RGBA array
+    mode = 'L' if thumbnail.ndim == 2 else 'RGB' if thumbnail.shape[2] == 3 else 'RGBA'
+    _upscale(PIL.Image.fromarray(thumbnail, mode)).save(save_to, optimize=False, compress_level=1)
+
+
+def _upscale(img: PIL.Image.Image) -> PIL.Image.Image:
+    # scaled by a whole number with nearest neighbour, so graphviz doesn't blur small images into a smear
+    scale = _THUMBNAIL_SIZE // max(img.size)
+    if scale <= 1:
+        return img
+    return img.resize((img.width * scale, img.height * scale), PIL.Image.Resampling.NEAREST)
+
+
 def is_image(value: Any) -> bool:
     """
     Return true if the given value should be rendered as an image (if it is an 2D numpy array or an Image type)
@@ -281,11 +542,12 @@ def is_image(value: Any) -> bool:
         True if it meets this opinionated condition for being rendered as an image.
     """
 
-    return isinstance(value, PIL.Image.Image) or isinstance(value, np.ndarray) and len(value.shape) == 2
+    # arrays are the common case, so they are checked first
+    return (isinstance(value, np.ndarray) and value.ndim == 2) or isinstance(value, PIL.Image.Image)
 
-def draw_image(graph: pgv.AGraph, tree: Tree[Any], image: Optional[image]=None) -> None:
+def draw_image(graph: pgv.AGraph, tree: Tree[Any], image: Optional[image]=None) -> bool:
     """
-    Add an image to the to the given graph with an id of f"{tree.id()}result".
+    Add an image to the to the given graph with an id of tree.result_id().
 
     Parameters
     ----------
@@ -293,20 +555,59 @@ def draw_image(graph: pgv.AGraph, tree: Tree[Any], image: Optional[image]=None)
         The graph to add a node to.
     tree : Tree[image]
         The tree to get the image to draw from.
+
+    Returns
+    -------
+    bool
+        True, as a result node is always added.
     """
+    drawing = _drawing.get()
+    thumbnail = None
     if image is None:
         assert is_image(tree.value)
         image = tree.value
+        # only use the thumbnail made in get_graph if it is of the current value
+        if drawing is not None and tree._id in drawing.thumbnails:
+            value, normalized = drawing.thumbnails[tree._id]
+            if value is image:
+                thumbnail = normalized
 
     if image is None:
-        raise ValueError("Tried to draw an image for a tree which has not been evaluated.\nMake sure to use `TreeDrawer().get_graph(tree, ...)`, or `tree._evaluate_all_nodes(...)` before running this.")
-
-    save_img(image, save_to=f'_treedata/{tree.id()}.png')
-
-    graph.add_node(f"{tree.id()}result", image=f'_treedata/{tree.id()}.png', label="", imagescale=True, fixedsize=True, shape="plaintext", width=2, height=2)
-
-
-def draw_text(graph: pgv.AGraph, tree: Tree[Any], text: Optional[str]=None) -> None:
+        raise ValueError("Tried to draw an image for a tree which has not been evaluated.\nMake sure to use `TreeDrawer().get_graph(tree, ...)`, or `tree.evaluate(...)` before running this.")
+
+    if thumbnail is not None:
+        path = _image_path(b"thumbnail", str(thumbnail.shape).encode(), thumbnail.tobytes())
+        write, data = _save_thumbnail, thumbnail
+    elif isinstance(image, PIL.Image.Image):
+        # the pixel data of palette images are only indices, so the palette (and which entry is transparent) is part of the content too
+        palette = image.getpalette() or []
+        path = _image_path(b"pil", f"{image.mode}{image.size}{image.info.get('transparency')!r}".encode(), bytes(palette), image.tobytes())
+        write, data = save_img_fast, image
+    else:
+        array = np.ascontiguousarray(image)
+        path = _image_path(b"array", f"{array.dtype}{array.shape}".encode(), array.tobytes())
+        write, data = save_img_fast, array
+
+    # skip the write if the same image has already been (or is being) written
+    future = _image_writes.get(path)
+    if drawing is None:
+        # outside get_graph nothing waits for a background write, so the image is written before this returns
+        if future is not None:
+            wait([future])
+        if not os.path.exists(path):
+            _write_image(write, data, path)
+    else:
+        if (future is None or future.done()) and not os.path.exists(path):
+            future = _image_writes[path] = _image_writer.submit(_write_image, write, data, path)
+            future.add_done_callback(lambda done: _image_writes.pop(path) if _image_writes.get(path) is done else None)
+        if future is not None:
+            drawing.image_writes.append((tree, future))
+
+    graph.add_node(tree._result_id, image=path, label="", imagescale=True, fixedsize=True, shape="plaintext", width=2, height=2)
+    return True
+
+
+def draw_text(graph: pgv.AGraph, tree: Tree[Any], text: Optional[str]=None) -> bool:
     """
     Draw the given text to the graph.
 
@@ -318,8 +619,60 @@ def draw_text(graph: pgv.AGraph, tree: Tree[Any], text: Optional[str]=None) -> N
         This is needed to get the id from
     text : str
         The text to draw to the graph
+
+    Returns
+    -------
+    bool
+        True, as a result node is always added.
     """
     if text is None:
         text = str(tree.value)
-    graph.add_node(f"{tree.id()}result", label=f"{text}", shape="plaintext")
+    graph.add_node(tree._result_id, label=f"{text}", shape="plaintext")
+    return True
+
+
+def _write_image(write: Callable[[Any, str], None], data: Any, path: str) -> None:
+    # requires a directory to store images in :( (made here, as it may have been removed, or the working directory changed, since the last write)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # written to a temporary file then moved into place, so an interrupted write never leaves a truncated file to be reused
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-", suffix=".png")
+    os.close(fd)
+    try:
+        write(data, temp_path)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def _image_path(*parts: bytes) -> str:
+    # the thumbnail size is included, so files rendered at another size aren't reused
+    digest = hashlib.blake2b(str(_THUMBNAIL_SIZE).encode(), digest_size=8)
+    for part in parts:
+        digest.update(part)
+    return f'_treedata/{digest.hexdigest()}.png'
+
+
+def _quote(text: str) -> str:
+    # a double quoted dot string, where only quotes need escaping
+    return '"' + text.replace('"', '\\"') + '"'
+
+
+def _classify(tree: Tree[Any]) -> str:
+    # constant terminals show nothing (their label already has the value), images are drawn, everything else is text
+    if tree.function.arity == 0 and "ARG" not in tree.function.name:
+        return "constant"
+    if is_image(tree.value):
+        return "image"
+    return "text"
+
+
+def _draw_default(graph: pgv.AGraph, tree: Tree[Any]) -> bool:
+    match _classify(tree):
+        case "constant":
+            return False
+        case "image":
+            return draw_image(graph, tree)
+        case _:
+            return draw_text(graph, tree)
 
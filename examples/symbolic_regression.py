@@ -6,12 +6,13 @@ from deap_tree import Tree, TreeDrawer, draw_text
 # This code is grabbed from the deap examples page (https://github.com/DEAP/deap/blob/0ebb47e34298885840fa7474fa9ffb9c7d7f2c8d/examples/gp/symbreg.py)
 
 import operator
-import math
 import random
 
+from multiprocessing import Pool
+
 import numpy
 
-from functools import partial
+from functools import lru_cache, partial
 
 from deap import algorithms
 from deap import base
@@ -19,12 +20,20 @@ from deap import creator
 from deap import tools
 from deap import gp
 
+try:
+    from numba import njit
+except ImportError:
+    # numba is optional, without it the error is calculated with plain numpy
+    njit = None
+
 # Define new functions
+# Changed to work on numpy arrays, so a whole set of points can be evaluated at once
 def protectedDiv(left, right):
-    try:
-        return left / right
-    except ZeroDivisionError:
-        return 1
+    # Only divides where right isn't 0, leaving the 1s it was filled with (so nothing is raised or warned about)
+    out = numpy.ones(numpy.broadcast_shapes(numpy.shape(left), numpy.shape(right)))
+    numpy.divide(left, right, out=out, where=numpy.not_equal(right, 0))
+    # [()] turns the 0d array for scalar inputs back into a scalar
+    return out[()]
 
 pset = gp.PrimitiveSet("MAIN", 1)
 pset.addPrimitive(operator.add, 2)
@@ -32,8 +41,8 @@ pset.addPrimitive(operator.sub, 2)
 pset.addPrimitive(operator.mul, 2)
 pset.addPrimitive(protectedDiv, 2)
 pset.addPrimitive(operator.neg, 1)
-pset.addPrimitive(math.cos, 1)
-pset.addPrimitive(math.sin, 1)
+pset.addPrimitive(numpy.cos, 1)
+pset.addPrimitive(numpy.sin, 1)
 pset.addEphemeralConstant("rand101", partial(random.randint, -1, 1))
 pset.renameArguments(ARG0='x')
 
@@ -46,15 +55,36 @@ toolbox.register("individual", tools.initIterate, creator.Individual, toolbox.ex
 toolbox.register("population", tools.initRepeat, list, toolbox.individual)
 toolbox.register("compile", gp.compile, pset=pset)
 
-def evalSymbReg(individual, points):
+POINTS = numpy.asarray([x/10. for x in range(-10,10)])
+TARGET = numpy.sin(POINTS**2) - POINTS
+
+if njit is not None:
+    @njit(cache=True, fastmath=True)
+    def _mse(pred, target):
+        total = 0.0
+        for i in range(pred.size):
+            diff = pred[i] - target[i]
+            total += diff * diff
+        return total / pred.size
+else:
+    def _mse(pred, target):
+        return numpy.mean((pred - target)**2)
+
+@lru_cache(maxsize=4096)
+def _evalExpr(expr):
     # Transform the tree expression in a callable function
-    func = toolbox.compile(expr=individual)
+    func = toolbox.compile(expr=expr)
     # Evaluate the mean squared error between the expression
-    # Function changed for this example
-    sqerrors = ((func(x) - (math.sin(x**2) - x))**2 for x in points)
-    return math.fsum(sqerrors) / len(points),
+    # Function changed for this example, evaluates all the points at once
+    # (constant trees give back a single number, so broadcast it to one prediction per point)
+    pred = numpy.ascontiguousarray(numpy.broadcast_to(func(POINTS), POINTS.shape), dtype=numpy.float64)
+    return _mse(pred, TARGET)
+
+def evalSymbReg(individual):
+    # The population is full of identical individuals, so the error is cached by the expression's string
+    return _evalExpr(str(individual)),
 
-toolbox.register("evaluate", evalSymbReg, points=[x/10. for x in range(-10,10)])
+toolbox.register("evaluate", evalSymbReg)
 toolbox.register("select", tools.selTournament, tournsize=3)
 toolbox.register("mate", gp.cxOnePoint)
 toolbox.register("expr_mut", gp.genFull, min_=0, max_=2)
@@ -77,8 +107,14 @@ def main():
     mstats.register("min", numpy.min)
     mstats.register("max", numpy.max)
 
-    pop, log = algorithms.eaSimple(pop, toolbox, 0.5, 0.1, 40, stats=mstats,
-                                   halloffame=hof, verbose=True)
+    # Evaluate the individuals in parallel, then go back to the builtin map once the pool is closed
+    with Pool() as pool:
+        toolbox.register("map", pool.map)
+        try:
+            pop, log = algorithms.eaSimple(pop, toolbox, 0.5, 0.1, 40, stats=mstats,
+                                           halloffame=hof, verbose=True)
+        finally:
+            toolbox.register("map", map)
     # print log
     return pop, log, hof
 
@@ -0,0 +1,241 @@
+import copy
+import math
+import operator
+import pickle
+import random
+import shutil
+
+import numpy as np
+import PIL.Image
+import pygraphviz as pgv
+import pytest
+from deap import gp
+
+from deap_tree import Tree, TreeDrawer, _Drawing, _drawing, _normalize_images, draw_image, draw_text
+
+
+def _protected_div(left, right):
+    try:
+        return left / right
+    except ZeroDivisionError:
+        return 1
+
+
+_pset = gp.PrimitiveSet("EVALUATE", 2)
+_pset.addPrimitive(operator.add, 2)
+_pset.addPrimitive(operator.sub, 2)
+_pset.addPrimitive(operator.mul, 2)
+_pset.addPrimitive(_protected_div, 2)
+_pset.addPrimitive(operator.neg, 1)
+_pset.addTerminal(1.0)
+_pset.addTerminal(-2.5)
+_pset.renameArguments(ARG0="x")
+
+
+# get_graph lays the graph out with graphviz's dot program
+_needs_dot = pytest.mark.skipif(shutil.which("dot") is None, reason="graphviz's dot is not installed")
+
+
+def _same(left, right):
+    return left == right or (math.isnan(left) and math.isnan(right))
+
+
+def test_evaluate_zero_argument_primitive_before_other_children():
+    pset = gp.PrimitiveSetTyped("MAIN", [float], float)
+    pset.addPrimitive(operator.add, [float, float], float)
+    pset.addPrimitive(lambda: 5.0, [], float, name="five")
+    model = gp.PrimitiveTree.from_string("add(five(), ARG0)", pset)
+
+    tree = Tree.of(model, pset)
+
+    assert tree.evaluate(3.0) == 8.0
+    assert [node.value for node in tree.nodes()] == [8.0, 5.0, 3.0]
+
+
+def test_tree_can_be_built_before_its_primitives_are_added():
+    model = gp.PrimitiveTree.from_string("sub(x, ARG1)", _pset)
+    pset = gp.PrimitiveSet("LATE", 2)
+    pset.renameArguments(ARG0="x")
+
+    tree = Tree.of(model, pset)
+    pset.addPrimitive(operator.sub, 2)
+
+    assert tree.evaluate(5, 3) == 2
+
+
+def test_evaluate_follows_a_replaced_function():
+    tree = Tree.of(gp.PrimitiveTree.from_string("add(x, x)", _pset), _pset)
+    assert tree.evaluate(3, 0) == 6
+
+    tree.function = _pset.mapping["mul"]
+    tree.children[1].function = _pset.mapping["1.0"]
+
+    assert tree.evaluate(3, 0) == tree.compile()(3, 0) == 3
+
+
+def test_of_raises_for_truncated_model():
+    model = gp.PrimitiveTree.from_string("add(mul(x, ARG1), neg(1.0))", _pset)
+
+    with pytest.raises(ValueError):
+        Tree.of(model[:-2], _pset)
+
+
+def test_copied_subtrees_get_their_own_ids():
+    # (copy.copy shares the children, so it is only used on a leaf)
+    leaf = Tree.of(gp.PrimitiveTree.from_string("x", _pset), _pset)
+    sub = Tree(_pset.mapping["add"], [leaf, copy.copy(leaf)], _pset)
+    tree = Tree(_pset.mapping["mul"], [sub, copy.deepcopy(sub)], _pset)
+    tree = Tree(_pset.mapping["sub"], [tree, pickle.loads(pickle.dumps(tree))], _pset)
+
+    nodes = tree.nodes()
+
+    assert len({node.id() for node in nodes}) == len(nodes)
+    assert len({node.result_id() for node in nodes}) == len(nodes)
+
+
+@pytest.mark.parametrize("parallel", [False, True])
+def test_evaluate_matches_compile_for_every_node(parallel):
+    rng = random.Random(0)
+    random.seed(0)
+    for _ in range(2000):
+        tree = Tree.of(gp.PrimitiveTree(gp.genGrow(_pset, 0, 5)), _pset)
+        inputs = (rng.uniform(-10, 10), rng.uniform(-10, 10))
+
+        result = tree.evaluate(*inputs, parallel=parallel)
+
+        assert _same(result, gp.compile(repr(tree), _pset)(*inputs))
+        for node in tree.nodes():
+            assert _same(node.value, gp.compile(repr(node), _pset)(*inputs)), repr(node)
+
+
+def test_draw_image_names_distinct_images_apart(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    red = PIL.Image.new("P", (4, 4))
+    red.putpalette([255, 0, 0])
+    blue = PIL.Image.new("P", (4, 4))
+    blue.putpalette([0, 0, 255])
+    images = [
+        red,
+        blue,
+        np.zeros((4, 4)),
+        np.ones((4, 4)),
+        np.zeros((4, 4), dtype=np.float32),
+        np.zeros((2, 8)),
+    ]
+    graph = pgv.AGraph()
+
+    paths = []
+    for image in images:
+        tree = Tree.of(gp.PrimitiveTree.from_string("x", _pset), _pset)
+        draw_image(graph, tree, image)
+        paths.append(graph.get_node(tree.result_id()).attr["image"])
+        assert (tmp_path / paths[-1]).exists()
+
+    assert len(set(paths)) == len(images)
+
+
+def test_normalize_images_ranges_over_finite_values():
+    images = np.array([[[0, 2], [1, 2]], [[1, np.inf], [-np.inf, np.nan]]])
+
+    assert _normalize_images(images).tolist() == [[[0, 255], [127, 255]], [[0, 255], [0, 0]]]
+
+
+def test_normalize_images_without_a_range():
+    images = np.array([np.full((2, 2), 7.0), [[np.inf, -np.inf], [np.nan, np.nan]]])
+
+    assert _normalize_images(images).tolist() == [[[0, 0], [0, 0]], [[255, 0], [0, 0]]]
+
+
+def test_normalize_images_of_bools():
+    normalized = _normalize_images(np.array([[[True, False], [False, True]]]))
+
+    assert normalized.dtype == np.uint8
+    assert normalized.tolist() == [[[255, 0], [0, 255]]]
+
+
+def test_normalize_thumbnails_only_numeric_2d_arrays():
+    values = [np.arange(4.0).reshape(2, 2), np.ones((2, 2), dtype=bool), np.array([["a", "b"], ["c", "d"]]), np.arange(4.0)]
+    nodes = [Tree(_pset.mapping["x"], [], _pset, value) for value in values]
+
+    thumbnails = TreeDrawer()._normalize_thumbnails(nodes)
+
+    assert set(thumbnails) == {nodes[0].id(), nodes[1].id()}
+    assert thumbnails[nodes[0].id()][0] is values[0]
+    assert thumbnails[nodes[0].id()][1].tolist() == [[0, 85], [170, 255]]
+
+
+def test_draw_image_only_reuses_thumbnail_of_current_value(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    tree = Tree(_pset.mapping["x"], [], _pset, np.arange(4.0).reshape(2, 2))
+    drawing = _Drawing(thumbnails=TreeDrawer()._normalize_thumbnails([tree]))
+    graph = pgv.AGraph()
+
+    token = _drawing.set(drawing)
+    try:
+        draw_image(graph, tree)
+        from_thumbnail = graph.get_node(tree.result_id()).attr["image"]
+        # an equal array, but not the one the thumbnail was made from
+        tree.value = tree.value.copy()
+        draw_image(graph, tree)
+        from_value = graph.get_node(tree.result_id()).attr["image"]
+    finally:
+        _drawing.reset(token)
+    for _, write in drawing.image_writes:
+        write.result()
+
+    assert from_thumbnail != from_value
+
+
+@_needs_dot
+def test_get_graph_with_non_numeric_image(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    tree = Tree.of(gp.PrimitiveTree.from_string("x", _pset), _pset)
+    drawer = TreeDrawer().register_draw_function(lambda t: t.value.dtype.kind == "U", lambda graph, t: draw_text(graph, t, "strings"))
+
+    graph = drawer.get_graph(tree, np.array([["a", "b"], ["c", "d"]]), 0)
+
+    assert graph.get_node(tree.result_id()).attr["label"] == "strings"
+
+
+@_needs_dot
+def test_get_graph_nodes_and_edges(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    pset = gp.PrimitiveSet("DRAW", 1)
+    pset.addPrimitive(operator.sub, 2, name='say"sub')
+    pset.addTerminal(1.0)
+    tree = Tree.of([pset.mapping['say"sub'], pset.mapping["ARG0"], pset.mapping["1.0"]], pset)
+    root, arg, constant = tree.nodes()
+    # a draw function that adds a node but doesn't say so
+    drawer = TreeDrawer().register_draw_function(lambda t: t is root, lambda graph, t: graph.add_node(t.result_id(), label="custom"))
+
+    graph = drawer.get_graph(tree, 3.0)
+
+    assert set(graph.nodes()) == {root.id(), arg.id(), constant.id(), root.result_id(), arg.result_id()}
+    assert set(graph.edges()) == {
+        (root.id(), arg.id()),
+        (root.id(), constant.id()),
+        (root.id(), root.result_id()),
+        (arg.id(), arg.result_id()),
+    }
+    assert graph.get_node(root.id()).attr["label"] == 'say"sub'
+    assert graph.get_node(constant.id()).attr["label"] == "1.0"
+    assert graph.get_node(root.result_id()).attr["label"] == "custom"
+    assert graph.get_node(arg.result_id()).attr["label"] == "3.0"
+    assert {subgraph.name for subgraph in graph.subgraphs()} == {f"{root.id()}-resultholder", f"{arg.id()}-resultholder"}
+    assert set(graph.get_subgraph(f"{root.id()}-resultholder").nodes()) == {root.id(), root.result_id()}
+
+
+@_needs_dot
+def test_get_graph_sees_direct_edits_to_drawing_method(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    tree = Tree.of(gp.PrimitiveTree.from_string("x", _pset), _pset)
+    drawer = TreeDrawer()
+    drawer.get_graph(tree, 1.0, 0)
+
+    drawer.drawing_method.insert(0, (lambda _: True, lambda graph, t: draw_text(graph, t, "custom")))
+    graph = drawer.get_graph(tree, 1.0, 0)
+    assert graph.get_node(tree.result_id()).attr["label"] == "custom"
+
+    drawer.drawing_method = [(lambda _: True, lambda *_: False)]
+    graph = drawer.get_graph(tree, 1.0, 0)
+    assert not graph.has_node(tree.result_id())